@@ -1,97 +1,212 @@
 from flask import Flask, request, abort
-import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
-import traceback
 import os
+import re
+import time
+import threading
+import hmac
+import hashlib
+import base64
+from collections import OrderedDict, defaultdict, deque
+from dataclasses import dataclass
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from cachetools import TTLCache
 
+# === JSON 編解碼（優先使用 orjson，未安裝時退回標準庫 json） ===
+try:
+    import orjson
 
+    _loads = orjson.loads
+
+    def _dumps(obj, indent=False):
+        option = orjson.OPT_INDENT_2 if indent else 0
+        return orjson.dumps(obj, option=option)
+except ImportError:
+    import json
+
+    _loads = json.loads
+
+    def _dumps(obj, indent=False):
+        return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None).encode("utf-8")
+
+load_dotenv()
+
+# LOG_LEVEL 不合法時退回 INFO，避免匯入時直接拋出 ValueError 讓 worker 無法啟動
+LOG_LEVEL = (os.getenv("LOG_LEVEL") or "INFO").upper()
+_log_level = logging.getLevelName(LOG_LEVEL)
+_log_level_valid = isinstance(_log_level, int)
+if not _log_level_valid:
+    _log_level = logging.INFO
 
 logging.basicConfig(
-    level=logging.INFO,
+    level=_log_level,
     format="%(asctime)s | %(levelname)s | %(message)s",
     datefmt="%Y-%m-%d %H:%M:%S",
 )
 
+if not _log_level_valid:
+    logging.warning("LOG_LEVEL=%s 不是合法的日誌等級，改用 INFO", LOG_LEVEL)
 
-app = Flask(__name__)
 
-load_dotenv()
+app = Flask(__name__)
 
 CHANNEL_ACCESS_TOKEN = os.getenv("CHANNEL_ACCESS_TOKEN")
 CHANNEL_SECRET = os.getenv("CHANNEL_SECRET")
 
+if not CHANNEL_SECRET:
+    logging.warning("未設定 CHANNEL_SECRET，所有 webhook 請求都會因簽章驗證失敗而被拒絕")
+_CHANNEL_SECRET_BYTES = (CHANNEL_SECRET or "").encode("utf-8")
+
+# LINE API 的標頭只在啟動時組一次，每次呼叫直接重用
+_LINE_AUTH_HEADERS = {"Authorization": f"Bearer {CHANNEL_ACCESS_TOKEN}"}
+_LINE_JSON_HEADERS = {**_LINE_AUTH_HEADERS, "Content-Type": "application/json"}
+
+# === 共用 HTTP 連線（重複使用 TCP / TLS 連線，避免每次呼叫重新握手） ===
+# 只重試冪等請求（GET）與連線失敗；reply token 只能用一次，POST 不因狀態碼重送
+LINE_API_TIMEOUT = (3.05, 10)  # (連線, 讀取) 秒
+
+http_session = requests.Session()
+http_session.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=50,
+    max_retries=Retry(total=2, backoff_factor=0.1, status_forcelist=[429, 500, 502, 503, 504]),
+))
+
+# 查無資料時共用的不可變預設值，避免每次 .get() 都配置新的空 list
+_EMPTY = ()
+
 # === 模擬詐騙分析結果 ===
-def analyze_text(text):
-    scam_keywords = [
-    "怎麼投資", "怎麼給你", "錢怎麼轉", 
+SCAM_KEYWORDS = [
+    "怎麼投資", "怎麼給你", "錢怎麼轉",
     "要匯到哪", "我相信你", "我沒有別人可以相信了"]
 
-    if any(word in text for word in scam_keywords):
-        return {
-            "label": "scam",
-            "confidence": 0.9,
-            "reply": "這是我投資成功的故事，你想聽嗎？"
-        }
+# 關鍵字在啟動時建成 Aho-Corasick 自動機，比對只需掃過訊息一次
+# （未安裝 pyahocorasick 時改用預先編譯的正規表示式，同樣只掃一次）
+try:
+    import ahocorasick
+
+    _SCAM_AUTOMATON = ahocorasick.Automaton()
+    for _keyword in SCAM_KEYWORDS:
+        _SCAM_AUTOMATON.add_word(_keyword, _keyword)
+    _SCAM_AUTOMATON.make_automaton()
+
+    def contains_scam_keyword(text):
+        return next(_SCAM_AUTOMATON.iter(text), None) is not None
+except ImportError:
+    _SCAM_RE = re.compile("|".join(re.escape(word) for word in SCAM_KEYWORDS))
+
+    def contains_scam_keyword(text):
+        return _SCAM_RE.search(text) is not None
+
+# 快速篩選：比最短關鍵字還短的訊息不可能命中，不必啟動比對
+_MIN_KEYWORD_LEN = min(len(word) for word in SCAM_KEYWORDS)
+
+# 共用的分析結果（唯讀，呼叫端若要修改請先 dict(result) 複製一份）
+_SCAM_RESULT = MappingProxyType({
+    "label": "scam",
+    "confidence": 0.9,
+    "reply": "這是我投資成功的故事，你想聽嗎？"
+})
+_SAFE_RESULT = MappingProxyType({
+    "label": "safe",
+    "confidence": 0.1,
+    "reply": "哈哈你說得真有趣，我懂你！"
+})
+
+def analyze_text(text):
+    if len(text) < _MIN_KEYWORD_LEN:
+        return _SAFE_RESULT
+    if contains_scam_keyword(text):
+        return _SCAM_RESULT
     else:
-        return {
-            "label": "safe",
-            "confidence": 0.1,
-            "reply": "哈哈你說得真有趣，我懂你！"
-        }
+        return _SAFE_RESULT
 
 # === 傳送資料到 API 伺服器並接收回覆語句 + 詐騙風險分析 ===
+ANALYSIS_API_URL = os.getenv("ANALYSIS_API_URL", "https://example.com/api/analyze")  # 替換成正式 API URL
+_ANALYSIS_API_HEADERS = {"Content-Type": "application/json"}
+
 def send_to_api(data):
     try:
-        api_url = "https://example.com/api/analyze"  # 替換成正式 API URL
-        headers = {"Content-Type": "application/json"}
-        res = requests.post(api_url, headers=headers, data=json.dumps(data), timeout=5)
+        res = http_session.post(ANALYSIS_API_URL, headers=_ANALYSIS_API_HEADERS, data=_dumps(data), timeout=5)
         if res.status_code == 200:
-            print(res.json())  # 印出回傳內容方便 debug
-            return res.json()
+            result = _loads(res.content)
+            logging.debug("分析 API 回傳：%s", result)  # 印出回傳內容方便 debug
+            return result
         else:
-            print(f"API 回應錯誤：{res.status_code}")
+            logging.warning("API 回應錯誤：%s", res.status_code)
             return {"label": "unknown", "confidence": 0.0, "reply": "目前系統繁忙，請稍後再試。"}
     except Exception as e:
-        print(f"傳送 API 發生錯誤：{e}")
+        logging.exception("傳送 API 發生錯誤：%s", e)
         return {"label": "unknown", "confidence": 0.0, "reply": "目前系統無法使用，請晚點再聊。"}
 
 # 回傳生成的詐騙訊息
 def generate_reply(result):
     return result.get("reply", "我還想聽更多～")
 
-# 判斷是否需要警示訊息
-def should_warn(result):
-    return result.get("label") == "scam" and result.get("confidence", 0.0) > 0.7
+# 判斷是否需要警示訊息（詐騙且可信度高於門檻）
+WARNING_CONFIDENCE_THRESHOLD = 0.7
 
-# 如果需要警示，產生警示內容
-def generate_warning(result):
-    confidence = result.get("confidence", 0.0)
-    return f"[警示] 你可能正被詐騙，請提高警覺（可信度 {confidence * 100:.1f}%）"
+def should_warn(label, confidence):
+    return label == "scam" and confidence > WARNING_CONFIDENCE_THRESHOLD
+
+# 如果需要警示，產生警示內容（只在需要警示時才格式化）
+WARNING_TEMPLATE = "[警示] 你可能正被詐騙，請提高警覺（可信度 {:.1f}%）"
+
+def generate_warning(confidence):
+    return WARNING_TEMPLATE.format(confidence * 100)
+
+# === 使用者資料快取（個人資料很少變動，避免每則訊息都呼叫 LINE API） ===
+PROFILE_CACHE_SIZE = 10_000
+PROFILE_CACHE_TTL = 3600  # 秒
+PROFILE_FAILURE_TTL = 60  # 秒，取得失敗時短暫快取，避免持續打同一個 user_id
+
+_profile_cache = TTLCache(maxsize=PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL)
+_profile_failure_cache = TTLCache(maxsize=PROFILE_CACHE_SIZE, ttl=PROFILE_FAILURE_TTL)
+_profile_lock = threading.Lock()
 
-# === 獲取使用者基本資料 ===
 def get_user_profile(user_id):
+    with _profile_lock:
+        profile = _profile_cache.get(user_id)
+        if profile is None:
+            profile = _profile_failure_cache.get(user_id)
+    if profile is not None:
+        return profile
+
+    profile = fetch_user_profile(user_id)
+    with _profile_lock:
+        if profile:
+            _profile_cache[user_id] = profile
+        else:
+            _profile_failure_cache[user_id] = profile
+    return profile
+
+def invalidate_profile(user_id):
+    with _profile_lock:
+        _profile_cache.pop(user_id, None)
+        _profile_failure_cache.pop(user_id, None)
+
+# === 獲取使用者基本資料 ===
+def fetch_user_profile(user_id):
     try:
         url = f"https://api.line.me/v2/bot/profile/{user_id}"
-        headers = {
-            "Authorization": f"Bearer {CHANNEL_ACCESS_TOKEN}"
-        }
-        res = requests.get(url, headers=headers)
+        res = http_session.get(url, headers=_LINE_AUTH_HEADERS, timeout=LINE_API_TIMEOUT)
         if res.status_code == 200:
-            return res.json()
+            return _loads(res.content)
         else:
-            logging.warning(f"取得使用者資料失敗，狀態碼：{res.status_code}")
+            logging.warning("取得使用者資料失敗，狀態碼：%s", res.status_code)
     except Exception as e:
-        logging.error("[get_user_profile 錯誤]")
-        logging.error(traceback.format_exc())
+        logging.exception("[fetch_user_profile 錯誤] %s", e)
     return {}  
 
 
 # === 整合資料給模型 / API 使用 ===
-def prepare_analysis_data(user_id, message):
+def prepare_analysis_data(user_id, message, history):
     profile = get_user_profile(user_id)
-    history = user_chat_history.get(user_id, [])
     return {
         "user_id": user_id,
         "display_name": profile.get("displayName", ""),
@@ -102,76 +217,252 @@ def prepare_analysis_data(user_id, message):
     }
 
 # === 儲存聊天紀錄（記憶體版） ===
-user_chat_history = {}  # key: userId, value: list of text messages
-
-# === 接收來自 LINE 的訊息 ===
-@app.route("/callback", methods=["POST"])
-def callback():
-    body = request.get_data(as_text=True)
-
+# 每位使用者只保留最近 MAX_HISTORY_MESSAGES 則，閒置超過 HISTORY_TTL 秒的使用者整筆淘汰
+MAX_HISTORY_MESSAGES = 20
+HISTORY_CACHE_SIZE = 50_000
+HISTORY_TTL = 86400  # 秒
+
+user_chat_history = TTLCache(maxsize=HISTORY_CACHE_SIZE, ttl=HISTORY_TTL)  # key: userId, value: deque of text messages
+_history_lock = threading.Lock()
+
+# 寫入並取回最新紀錄在同一次加鎖內完成，回傳可直接序列化的 list
+def add_and_get_history(user_id, messages):
+    with _history_lock:
+        history = user_chat_history.get(user_id)
+        if history is None:
+            history = deque(maxlen=MAX_HISTORY_MESSAGES)
+        history.extend(messages)
+        # 重新寫入以更新到期時間，只有真正閒置的使用者才會被淘汰
+        user_chat_history[user_id] = history
+        return list(history)
+
+# reply token 的保守有效期限（秒），超過就改用 push API 回覆
+REPLY_TOKEN_DEADLINE = 25
+
+# === LINE 事件（解析一次後以屬性存取，不再逐層查 dict） ===
+@dataclass(slots=True, frozen=True)
+class LineEvent:
+    type: str | None
+    message_type: str | None
+    text: str | None
+    user_id: str | None
+    source_type: str | None  # user / group / room
+    chat_id: str | None  # 事件所在的聊天室：groupId、roomId，1 對 1 聊天時為 userId
+    reply_token: str | None
+    event_id: str | None
+    timestamp: int | None  # LINE 送出事件的時間（毫秒）
+
+    @classmethod
+    def from_dict(cls, event):
+        message = event.get("message")
+        source = event.get("source")
+        return cls(
+            type=event.get("type"),
+            message_type=message.get("type") if message else None,
+            text=message.get("text") if message else None,
+            user_id=source.get("userId") if source else None,
+            source_type=source.get("type") if source else None,
+            chat_id=(source.get("groupId") or source.get("roomId") or source.get("userId")) if source else None,
+            reply_token=event.get("replyToken"),
+            event_id=event.get("webhookEventId"),
+            timestamp=event.get("timestamp"),
+        )
+
+    # reply token 只在事件發生後短時間內有效，超過期限就只能改用 push
+    def reply_token_expired(self):
+        if self.timestamp is None:
+            return False
+        return time.time() - self.timestamp / 1000 > REPLY_TOKEN_DEADLINE
+
+# === 處理同一使用者在同一聊天室、這批 webhook 中的文字訊息（於背景 worker 執行） ===
+# 同一批裡的多則訊息合併成一次分析、一次回覆，只用第一則訊息的 replyToken
+def process_user_events(chat_id, user_id, events):
     try:
-        json_data = json.loads(body)
-        logging.info("\n==== [Log] 接收到的資料 ====\n" + json.dumps(json_data, ensure_ascii=False, indent=2))
+        reply_token = events[0].reply_token
+        user_msgs = [event.text for event in events]
+
+        # 儲存聊天紀錄
+        history = add_and_get_history(user_id, user_msgs)
+        user_msg = "\n".join(user_msgs)
+
+        # 準備分析資料（模擬送出）
+        analysis_data = prepare_analysis_data(user_id, user_msg, history)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("\n==== [Log] 準備送出的分析資料 ====\n%s", _dumps(analysis_data, indent=True).decode("utf-8"))
+
+
+        # 分析結果
+        # result = send_to_api(analysis_data)  # 真實分析結果
+        result = analyze_text(user_msg)  # 模擬分析
+
+        # 回覆與警示分成兩則訊息，仍只呼叫一次 reply API
+        label = result.get("label")
+        confidence = result.get("confidence", 0.0)
+        reply_msgs = [generate_reply(result)]
+        if should_warn(label, confidence):
+            reply_msgs.append(generate_warning(confidence))
+
+        if events[0].reply_token_expired():
+            # 推播到事件所在的聊天室（群組 / 多人聊天室 / 1 對 1），與 reply token 原本會回覆的位置相同
+            logging.warning("reply token 已超過 %d 秒，改用推播回覆 %s（%s）", REPLY_TOKEN_DEADLINE, chat_id, events[0].source_type)
+            push_to_chat(chat_id, reply_msgs)
+        else:
+            reply_to_user(reply_token, reply_msgs)
 
+    except Exception as e:
+        logging.exception("==== [Log] 處理事件發生錯誤：%s ====", e)
 
-        events = json_data.get("events", [])
-        for event in events:
-            if event["type"] == "message" and event["message"]["type"] == "text":
-                reply_token = event["replyToken"]
-                user_msg = event["message"]["text"]
-                user_id = event["source"]["userId"]
+# === 背景 worker：讓 callback 立即回應 200，避免 LINE 因逾時重送 ===
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 8))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 100))
 
-                # 儲存聊天紀錄
-                user_chat_history.setdefault(user_id, []).append(user_msg)
+event_executor = ThreadPoolExecutor(max_workers=WEBHOOK_WORKERS, thread_name_prefix="webhook")
+_event_slots = threading.BoundedSemaphore(WEBHOOK_QUEUE_SIZE)
 
-                # 準備分析資料（模擬送出）
-                analysis_data = prepare_analysis_data(user_id, user_msg)
-                logging.info("\n==== [Log] 準備送出的分析資料 ====\n" + json.dumps(analysis_data, ensure_ascii=False, indent=2))
+def _release_event_slot(_future):
+    _event_slots.release()
 
+def dispatch_user_events(chat_id, user_id, events):
+    # 佇列已滿時改為同步處理，讓 LINE 端自然減速，而不是無上限地堆積工作
+    if not _event_slots.acquire(blocking=False):
+        logging.warning("事件佇列已滿（上限 %d），改為同步處理", WEBHOOK_QUEUE_SIZE)
+        process_user_events(chat_id, user_id, events)
+        return
+    try:
+        future = event_executor.submit(process_user_events, chat_id, user_id, events)
+    except Exception:
+        _event_slots.release()
+        raise
+    future.add_done_callback(_release_event_slot)
+
+# === 已處理的事件 ID（LINE 重送時避免重複回覆，依先進先出淘汰最舊的 ID） ===
+MAX_PROCESSED_EVENT_IDS = 2000
+
+_processed_event_ids = OrderedDict()  # key: webhookEventId, value: None
+_processed_event_lock = threading.Lock()
+
+def is_duplicate_event(event_id):
+    if not event_id:
+        return False
+    with _processed_event_lock:
+        if event_id in _processed_event_ids:
+            return True
+        _processed_event_ids[event_id] = None
+        if len(_processed_event_ids) > MAX_PROCESSED_EVENT_IDS:
+            _processed_event_ids.popitem(last=False)
+    return False
+
+# === 驗證 LINE 簽章（X-Line-Signature = base64(HMAC-SHA256(channel secret, body))） ===
+def verify_signature(body, signature):
+    if not _CHANNEL_SECRET_BYTES or not signature:
+        return False
+    mac = hmac.new(_CHANNEL_SECRET_BYTES, body, hashlib.sha256).digest()
+    return hmac.compare_digest(base64.b64encode(mac), signature.encode("utf-8"))
+
+# === 依事件類型分派（未列出的類型直接略過） ===
+def _collect_text_message(event, events_by_user):
+    if event.message_type == "text":
+        events_by_user[(event.chat_id, event.user_id)].append(event)
+
+def _refresh_profile(event, events_by_user):
+    # 使用者重新加入或封鎖時，下次訊息重新取得個人資料
+    invalidate_profile(event.user_id)
+
+_EVENT_HANDLERS = {
+    "message": _collect_text_message,
+    "follow": _refresh_profile,
+    "unfollow": _refresh_profile,
+}
 
-                # 分析結果
-                # result = send_to_api(analysis_data)  # 真實分析結果
-                result = analyze_text(user_msg)  # 模擬分析
+# === 接收來自 LINE 的訊息 ===
+@app.route("/callback", methods=["POST"])
+def callback():
+    body = request.get_data()
 
-                reply_msg = generate_reply(result)
-                if should_warn(result):
-                    reply_msg += "\n" + generate_warning(result)
+    # 先驗證簽章，未簽署的請求不做 JSON 解析或任何後續呼叫
+    signature = request.headers.get("X-Line-Signature", "")
+    if not verify_signature(body, signature):
+        logging.warning("LINE 簽章驗證失敗，拒絕請求")
+        abort(403)
 
-                reply_to_user(reply_token, reply_msg)
+    try:
+        json_data = _loads(body)
+        events = json_data.get("events", _EMPTY)
+        logging.info("==== [Log] 接收到 %d 個事件 ====", len(events))
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("\n==== [Log] 接收到的資料 ====\n%s", _dumps(json_data, indent=True).decode("utf-8"))
+
+        # 依（聊天室, 使用者）分組，同一位使用者在同一聊天室的文字訊息只分析、回覆一次；
+        # 不同聊天室分開處理，回覆才會回到原本的聊天室
+        events_by_user = defaultdict(list)
+        for raw_event in events:
+            event = LineEvent.from_dict(raw_event)
+            if is_duplicate_event(event.event_id):
+                logging.info("略過重複的事件：%s", event.event_id)
+                continue
+            if event.user_id:
+                handler = _EVENT_HANDLERS.get(event.type)
+                if handler is not None:
+                    handler(event, events_by_user)
+
+        for (chat_id, user_id), user_events in events_by_user.items():
+            dispatch_user_events(chat_id, user_id, user_events)
 
     except Exception as e:
-        logging.error("\n==== [Log] 發生錯誤 ====")
-        logging.error(str(e))
-        logging.error(traceback.format_exc())  
+        logging.exception("==== [Log] 發生錯誤：%s ====", e)
         abort(400)
 
 
 
     return "OK"
 
-# === 回傳訊息給使用者（使用 reply API） ===
-def reply_to_user(reply_token, text):
+# === 回傳訊息給使用者（reply / push API，一次最多 5 則） ===
+MAX_REPLY_MESSAGES = 5
+
+# 固定的 JSON 骨架預先編碼，每次只序列化 replyToken / to 與文字本身（_dumps 會處理跳脫）
+_REPLY_BODY_PREFIX = b'{"replyToken":'
+_PUSH_BODY_PREFIX = b'{"to":'
+_BODY_MESSAGES = b',"messages":['
+_BODY_SUFFIX = b']}'
+_TEXT_MESSAGE_PREFIX = b'{"type":"text","text":'
+_TEXT_MESSAGE_SUFFIX = b'}'
+
+def _encode_text_messages(texts):
+    return b",".join(
+        _TEXT_MESSAGE_PREFIX + _dumps(text) + _TEXT_MESSAGE_SUFFIX
+        for text in texts[:MAX_REPLY_MESSAGES]
+    )
+
+def build_reply_body(reply_token, texts):
+    return _REPLY_BODY_PREFIX + _dumps(reply_token) + _BODY_MESSAGES + _encode_text_messages(texts) + _BODY_SUFFIX
+
+def build_push_body(chat_id, texts):
+    return _PUSH_BODY_PREFIX + _dumps(chat_id) + _BODY_MESSAGES + _encode_text_messages(texts) + _BODY_SUFFIX
+
+def reply_to_user(reply_token, texts):
+    if isinstance(texts, str):
+        texts = [texts]
     try:
         url = "https://api.line.me/v2/bot/message/reply"
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {CHANNEL_ACCESS_TOKEN}"
-        }
-        payload = {
-            "replyToken": reply_token,
-            "messages": [
-                {
-                    "type": "text",
-                    "text": text
-                }
-            ]
-        }
-        res = requests.post(url, headers=headers, data=json.dumps(payload))
+        body = build_reply_body(reply_token, texts)
+        res = http_session.post(url, headers=_LINE_JSON_HEADERS, data=body, timeout=LINE_API_TIMEOUT)
+        if res.status_code != 200:
+            logging.warning("回傳訊息失敗，狀態碼：%s, 回傳內容：%s", res.status_code, res.text)
+    except Exception as e:
+        logging.exception("[reply_to_user 錯誤] %s", e)
+
+# === 主動推播訊息到聊天室（reply token 已過期時使用，會計入推播額度） ===
+def push_to_chat(chat_id, texts):
+    if isinstance(texts, str):
+        texts = [texts]
+    try:
+        url = "https://api.line.me/v2/bot/message/push"
+        body = build_push_body(chat_id, texts)
+        res = http_session.post(url, headers=_LINE_JSON_HEADERS, data=body, timeout=LINE_API_TIMEOUT)
         if res.status_code != 200:
-            logging.warning(f"回傳訊息失敗，狀態碼：{res.status_code}, 回傳內容：{res.text}")
+            logging.warning("推播訊息失敗，狀態碼：%s, 回傳內容：%s", res.status_code, res.text)
     except Exception as e:
-        logging.error("[reply_to_user 錯誤]")
-        logging.error(traceback.format_exc())
+        logging.exception("[push_to_chat 錯誤] %s", e)
 
 
 # === 測試首頁 ===